@@ -1,20 +1,56 @@
 from __future__ import annotations
+import re
 from dataclasses import dataclass
 
 from storage import Storage, Tx
 from router_fallback import FallbackRouter
 from router_llm import LLMRouter
-from utils import now_utc, fmt_money, detect_lang_ru, clean_text
+from utils import now_utc, fmt_money, detect_lang_ru, clean_text, words
+
+# «кофе 5», «доход 1200», «долг 30»: одно слово + сумма — LLM не нужен, если слово однозначно задаёт тип.
+# Только целые слова из списка: «paid», «оплата», «вернул» неоднозначны, «gas» сидит внутри «vegas»,
+# а незнакомое слово («зарплата 5000») fallback записал бы расходом — всё это решает LLM
+_SIMPLE_LOG_RE = re.compile(r"[^\W\d_]+ \d{1,9}(?:[.,]\d{1,2})?")
+_SIMPLE_LOG_WORDS = frozenset([
+    "кофе", "coffee", "бензин", "расход", "expense",
+    "доход", "income",
+    "долг", "debt",
+])
+
+# одиночные слова сверяем по набору слов (иначе «ку» ловится в «купил»), фразы — подстрокой
+_HELP_WORDS = frozenset(["помощь", "help", "команды"])
+_HELP_PHRASES = ("что ты умеешь", "что можешь")
+_GREET_WORDS = frozenset(["привет", "ку", "куку", "hi", "hello", "ау"])
+_GREET_PHRASES = ("как дела",)
+_CONFIRM_DELETE = ("удалить всё", "удалить все", "delete all")
+
+# подписи типов записей: в ответе на запись и в списке
+_KIND_LOGGED = {
+    "expense": "Расход",
+    "income": "Доход",
+    "debt": "Долг (взял/добавил)",
+    "pay_debt": "Оплата долга",
+}
+# SHOW выводит не больше стольких строк; остальные только считаем
+_SHOW_ROWS = 20
+_KIND_LISTED = {"expense": "расход", "income": "доход", "debt": "долг", "pay_debt": "оплата долга"}
+# SHOW с фильтром по типу: заголовок списка и «… нет»
+_KIND_SHOWN = {
+    "expense": ("Расходы", "расходов"),
+    "income": ("Доходы", "доходов"),
+    "debt": ("Долги", "долгов"),
+    "pay_debt": ("Оплаты долга", "оплат долга"),
+}
 
 @dataclass
 class UserCtx:
     pending_delete: bool = False
 
 class Brain:
-    def __init__(self, db, openai_client):
+    def __init__(self, db, openai_client, on_openai_health=None):
         self.storage = Storage(db)
         self.fallback = FallbackRouter()
-        self.llm = LLMRouter(openai_client=openai_client)
+        self.llm = LLMRouter(openai_client=openai_client, on_health=on_openai_health)
         self._mem: dict[int, UserCtx] = {}
 
     def _ctx(self, uid: int) -> UserCtx:
@@ -62,7 +98,7 @@ class Brain:
 
         # Подтверждение удаления
         if ctx.pending_delete:
-            if "удалить всё" in tl or "удалить все" in tl or "delete all" in tl:
+            if any(x in tl for x in _CONFIRM_DELETE):
                 self.storage.delete_all_user_data(uid)
                 ctx.pending_delete = False
                 return "Готово. Я удалил все твои данные."
@@ -71,15 +107,20 @@ class Brain:
             return "Ок, не удаляю. Что делаем дальше? Напиши «что ты умеешь»."
 
         # HELP если привет/что умеешь
-        if any(x in tl for x in ["что ты умеешь", "помощь", "help", "команды", "что можешь"]):
+        tw = words(tl)
+        if not _HELP_WORDS.isdisjoint(tw) or any(x in tl for x in _HELP_PHRASES):
             return self.help_text()
 
-        if any(x in tl for x in ["привет", "ку", "куку", "hi", "hello", "как дела", "ау"]):
+        if not _GREET_WORDS.isdisjoint(tw) or any(x in tl for x in _GREET_PHRASES):
             return "Привет 🙂 Чем займёмся? Могу записать расход/доход, показать за период, сделать сводку или дать совет. Напиши «что ты умеешь»."
 
+        # 0) fallback считаем один раз: он нужен и для «кофе 5» без LLM, и если LLM недоступен/упал
+        local = self.fallback.route(t)
+        local_only = local.intent == "LOG" and _SIMPLE_LOG_RE.fullmatch(t) and not _SIMPLE_LOG_WORDS.isdisjoint(tw)
+
         # 1) пытаемся LLM если доступен
         routed = None
-        if openai_ok:
+        if openai_ok and not local_only:
             try:
                 routed = self.llm.route(t)
             except Exception:
@@ -87,7 +128,7 @@ class Brain:
 
         # 2) если LLM нет — fallback
         if not routed:
-            r = self.fallback.route(t)
+            r = local
             intent = r.intent
             kind = r.kind
             amount = r.amount
@@ -120,31 +161,32 @@ class Brain:
                 note=(note or t)[:300],
                 currency=currency,
             ))
-            kind_ru = {
-                "expense": "Расход",
-                "income": "Доход",
-                "debt": "Долг (взял/добавил)",
-                "pay_debt": "Оплата долга",
-            }.get(kind, kind)
+            kind_ru = _KIND_LOGGED.get(kind, kind)
             return f"{kind_ru}: {fmt_money(float(amount), currency)} ✅"
 
         if intent == "SHOW":
             d = int(days or 7)
-            rows = self.storage.list_tx(uid, days=d)
+            # фильтр по типу делает Firestore (индекс tx(kind, ts)), а не мы после выборки
+            shown = _KIND_SHOWN.get(kind)
+            kind = kind if shown else None
+            rows = self.storage.list_tx(uid, days=d, kind=kind, limit=_SHOW_ROWS)
+            title, what = shown or ("Записи", "записей")
             if not rows:
-                return f"За последние {d} дней записей нет."
-            lines = [f"Записи за {d} дней (последние сверху):"]
-            # показываем максимум 20 строк
-            for r in rows[:20]:
+                return f"За последние {d} дней {what} нет."
+            lines = [f"{title} за {d} дней (последние сверху):"]
+            for r in rows:
                 k = r.get("kind")
                 a = float(r.get("amount") or 0)
                 cur = (r.get("currency") or currency).upper()
                 ts = r.get("ts")
                 date_s = ts.strftime("%Y-%m-%d") if ts else ""
-                k_ru = {"expense":"расход","income":"доход","debt":"долг","pay_debt":"оплата долга"}.get(k, k)
+                k_ru = _KIND_LISTED.get(k, k)
                 lines.append(f"• {date_s} — {k_ru}: {fmt_money(a, cur)} — {str(r.get('note') or '')[:60]}")
-            if len(rows) > 20:
-                lines.append(f"…и ещё {len(rows)-20} записей.")
+            # лишние записи не тянем — узнаём только их количество
+            if len(rows) == _SHOW_ROWS:
+                more = self.storage.count_tx(uid, days=d, kind=kind) - _SHOW_ROWS
+                if more > 0:
+                    lines.append(f"…и ещё {more} записей.")
             return "\n".join(lines)
 
         if intent == "SUMMARY":
@@ -189,19 +231,14 @@ class Brain:
             )
             try:
                 # вызываем LLM напрямую тем же роутером
-                from openai import OpenAI
-                # у нас client уже внутри llm; проще — сделать короткий запрос
-                # Но чтобы не плодить лишнее: используем llm.client
-                resp = self.llm.client.chat.completions.create(
-                    model=self.llm.model,
-                    temperature=0.4,
-                    messages=[
+                answer = self.llm.chat(
+                    [
                         {"role": "system", "content": "Ты — финансовый помощник. Пиши по-русски, коротко и по делу."},
                         {"role": "user", "content": prompt},
                     ],
-                    timeout=20,
+                    temperature=0.4,
                 )
-                return (resp.choices[0].message.content or "").strip() or "Могу дать совет, но сейчас ответ пустой. Попробуй ещё раз."
+                return answer or "Могу дать совет, но сейчас ответ пустой. Попробуй ещё раз."
             except Exception:
                 return "Не смог дать совет сейчас. Попробуй ещё раз через минуту."
 
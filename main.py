@@ -1,80 +1,163 @@
+import io
 import os
 import json
-import tempfile
-import traceback
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
+import httpx
+from cachetools import TTLCache
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 
 import firebase_admin
 from firebase_admin import credentials, firestore
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient, Timeout, APIConnectionError, APITimeoutError, InternalServerError
 
 from brain import Brain
+from router_llm import OPENAI_CONCURRENCY
 from utils import clean_text
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+# httpx пишет каждый запрос (getUpdates, OpenAI) на INFO — это шум
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 FIREBASE_SERVICE_ACCOUNT = os.getenv("FIREBASE_SERVICE_ACCOUNT", "").strip()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
+# если WEBHOOK_URL задан — Telegram сам пушит апдейты; без него — polling (для локальной разработки)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token; без него любой, кто знает URL,
+# может слать поддельные апдейты от чужого user.id (1–256 символов: A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+PORT = int(os.getenv("PORT", "8080"))
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is missing")
 if not FIREBASE_SERVICE_ACCOUNT:
     raise RuntimeError("FIREBASE_SERVICE_ACCOUNT is missing")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET is missing (required with WEBHOOK_URL)")
 if not OPENAI_API_KEY:
     # бот будет работать без OpenAI, но голос и “мозг” будут ограничены
-    print("WARNING: OPENAI_API_KEY is missing. Bot will run in fallback-only mode.")
+    logger.warning("OPENAI_API_KEY is missing. Bot will run in fallback-only mode.")
 
 # Firebase
-cred = credentials.Certificate(json.loads(FIREBASE_SERVICE_ACCOUNT))
+# сертификат парсим только если приложение ещё не поднято (например, при повторном импорте модуля)
 if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
+    firebase_admin.initialize_app(credentials.Certificate(json.loads(FIREBASE_SERVICE_ACCOUNT)))
 db = firestore.client()
 
 # OpenAI
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# connect=2 с: если OpenAI недоступен, падаем быстро, а не висим в хендлере все 20 с
+OPENAI_TIMEOUT = Timeout(20.0, connect=2.0)
+# один пул соединений на процесс; keepalive дольше фонового пинга (60 с) — TLS-рукопожатие не повторяется
+# на каждое сообщение (по умолчанию httpx держит соединение всего 5 с)
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=90.0)
+openai_client = (
+    OpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=OPENAI_TIMEOUT,
+        # SDK сам ретраит 429/5xx/таймауты с экспоненциальной паузой и учитывает Retry-After.
+        # Полный бюджет нужен STT (fallback нет); роутер/совет урезают его в LLMRouter
+        max_retries=3,
+        http_client=DefaultHttpxClient(limits=OPENAI_HTTP_LIMITS),
+    )
+    if OPENAI_API_KEY
+    else None
+)
 
-brain = Brain(db=db, openai_client=openai_client if openai_client else OpenAI(api_key="DUMMY"))
+# file_unique_id → расшифровка: пересланное/повторное голосовое не гоняем через STT ещё раз
+_VOICE_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=3600)
 
 
-async def is_openai_ok() -> bool:
-    # если ключа нет — точно нет
-    if not openai_client:
-        return False
+# Статус OpenAI кэшируем: пинг идёт в фоне раз в минуту, а не перед каждым сообщением
+OPENAI_HEALTH_TTL = 60.0
+_openai_health = {"ok": True, "ts": 0.0}
+
+
+def set_openai_health(ok: bool) -> None:
+    _openai_health["ok"] = ok
+    _openai_health["ts"] = time.monotonic()
+
+
+# исход каждого запроса роутера/совета сразу обновляет статус, не дожидаясь фонового пинга
+brain = Brain(
+    db=db,
+    openai_client=openai_client if openai_client else OpenAI(api_key="DUMMY"),
+    on_openai_health=set_openai_health if openai_client else None,
+)
+
+
+def probe_openai() -> bool:
     try:
-        # быстрый “пинг” через очень дешёвый запрос
-        _ = openai_client.models.list()
+        # быстрый “пинг” через очень дешёвый запрос; без ретраев и с коротким таймаутом —
+        # иначе при таймаутах OpenAI одна проверка висит ~80 с (4 попытки × 20 с)
+        _ = openai_client.with_options(max_retries=0, timeout=5.0).models.list()
         return True
     except Exception as e:
-        print("OpenAI check failed:", repr(e))
+        logger.warning("OpenAI check failed: %r", e)
         return False
 
 
+# handle/STT идут через asyncio.to_thread: пул по умолчанию — min(32, cpu+4) потоков, на маленьком
+# инстансе это 5–6 и есть реальный лимит, а не семафор OPENAI_CONCURRENCY. Ставим свой пул
+# (см. on_startup) с запасом под хендлеры, которые ждут только Firestore.
+HANDLER_THREADS = OPENAI_CONCURRENCY + 16
+# пинг — в отдельном потоке, чтобы не стоять в очереди за зависшими запросами к OpenAI
+_PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="openai-probe")
+
+
+async def run_probe() -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_PROBE_EXECUTOR, probe_openai)
+
+
+async def openai_health_loop():
+    while True:
+        set_openai_health(await run_probe())
+        await asyncio.sleep(OPENAI_HEALTH_TTL)
+
+
+async def is_openai_ok() -> bool:
+    # если ключа нет — точно нет
+    if not openai_client:
+        return False
+    # фоновый пинг почему-то не обновлялся — проверяем сами
+    if time.monotonic() - _openai_health["ts"] > 2 * OPENAI_HEALTH_TTL:
+        set_openai_health(await run_probe())
+    return _openai_health["ok"]
+
+
 async def transcribe_telegram_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     if not openai_client:
         raise RuntimeError("OpenAI client not configured")
 
     voice = update.message.voice
+    key = voice.file_unique_id
+    cached = _VOICE_CACHE.get(key)
+    if cached:
+        return cached
+
     tg_file = await context.bot.get_file(voice.file_id)
 
-    with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as tmp:
-        tmp_path = tmp.name
+    # качаем в память: без записи на диск и повторного чтения файла
+    buf = io.BytesIO()
+    await tg_file.download_to_memory(out=buf)
+    buf.seek(0)
+    buf.name = "voice.ogg"  # по имени SDK определяет формат
 
-    try:
-        await tg_file.download_to_drive(custom_path=tmp_path)
-        with open(tmp_path, "rb") as f:
-            tr = openai_client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=f,
-            )
-        text = getattr(tr, "text", None)
-        return clean_text(text or "")
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+    tr = await asyncio.to_thread(
+        openai_client.audio.transcriptions.create,
+        model="gpt-4o-mini-transcribe",
+        file=buf,
+    )
+    set_openai_health(True)
+    text = clean_text(getattr(tr, "text", None) or "")
+    if text:
+        _VOICE_CACHE[key] = text
+    return text
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -88,7 +171,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # просто вызываем через brain HELP
     user = update.effective_user
     ok = await is_openai_ok()
-    reply = brain.handle(user.id, user.username, user.first_name, "что ты умеешь", openai_ok=ok)
+    reply = await asyncio.to_thread(brain.handle, user.id, user.username, user.first_name, "что ты умеешь", openai_ok=ok)
     await update.message.reply_text(reply)
 
 
@@ -99,7 +182,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     ok = await is_openai_ok()
-    reply = brain.handle(user.id, user.username, user.first_name, text, openai_ok=ok)
+    # brain.handle синхронный (OpenAI + Firestore) — в потоке, чтобы не блокировать event loop
+    reply = await asyncio.to_thread(brain.handle, user.id, user.username, user.first_name, text, openai_ok=ok)
     await update.message.reply_text(reply)
 
 
@@ -116,9 +200,14 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         text = await transcribe_telegram_voice(update, context)
-    except Exception as e:
-        print("Voice STT error:", repr(e))
-        traceback.print_exc()
+    except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+        # OpenAI реально недоступен — не ждём следующего фонового пинга
+        set_openai_health(False)
+        logger.warning("Voice STT error: %r", e)
+        await update.message.reply_text("Не смог распознать голос. Попробуй ещё раз или напиши текстом.")
+        return
+    except Exception:
+        logger.exception("Voice STT error")
         await update.message.reply_text("Не смог распознать голос. Попробуй ещё раз или напиши текстом.")
         return
 
@@ -126,30 +215,68 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Не разобрал голос. Попробуй ещё раз или напиши текстом.")
         return
 
-    reply = brain.handle(user.id, user.username, user.first_name, text, openai_ok=True)
+    reply = await asyncio.to_thread(brain.handle, user.id, user.username, user.first_name, text, openai_ok=True)
     await update.message.reply_text(reply)
 
 
 async def on_startup(app):
-    # КРИТИЧНО: убираем webhook, чтобы polling не конфликтовал
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=HANDLER_THREADS, thread_name_prefix="handler")
+    )
+    if openai_client:
+        # post_init выполняется до app.start(): app.create_task здесь не отслеживается — держим задачу сами
+        app.bot_data["openai_health_task"] = asyncio.create_task(openai_health_loop())
+
+    if WEBHOOK_URL:
+        return
+    # КРИТИЧНО (только для polling): убираем webhook, чтобы polling не конфликтовал
     try:
         await app.bot.delete_webhook(drop_pending_updates=True)
-        print("Webhook deleted (drop pending updates).")
+        logger.info("Webhook deleted (drop pending updates).")
     except Exception as e:
-        print("delete_webhook error:", repr(e))
+        logger.warning("delete_webhook error: %r", e)
+
+
+async def on_shutdown(app):
+    task = app.bot_data.pop("openai_health_task", None)
+    if task:
+        task.cancel()
+
+
+# все хендлеры (команды, текст, голос) работают только с message — остальные апдейты не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE]
 
 
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(on_startup).build()
+    # concurrent_updates: апдейты разных пользователей обрабатываются параллельно, а не по одному
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(True)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
 
-    print("Bot started")
-    # allowed_updates=None → по умолчанию все нужные
-    app.run_polling(close_loop=False)
+    logger.info("Bot started")
+    if WEBHOOK_URL:
+        # run_webhook сам вызывает setWebhook и сбрасывает старые апдейты
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        return
+    # long polling: Telegram держит запрос до 30 с, пустых getUpdates почти нет
+    app.run_polling(close_loop=False, timeout=30, allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
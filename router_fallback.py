@@ -1,11 +1,11 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from typing import Literal
-from utils import clean_text, parse_days, parse_amount, is_income_phrase, is_expense_phrase, is_debt_phrase, is_pay_debt_phrase
+from utils import clean_text, parse_days, parse_amount, classify_phrase, build_keyword_matcher, words
 
 Intent = Literal["LOG", "SHOW", "SUMMARY", "ADVICE", "DELETE_DATA", "HELP", "UNKNOWN"]
 
-@dataclass
+@dataclass(slots=True)
 class Route:
     intent: Intent
     kind: str | None = None
@@ -13,45 +13,65 @@ class Route:
     days: int | None = None
     note: str | None = None
 
+# помощь/приветствия — целые слова, сверяем по набору слов сообщения
+_HELP_WORDS = frozenset(["помощь", "help", "команды", "привет", "hello", "hi", "ку", "куку", "ау"])
+
+# ключевые слова интентов (в т.ч. основы слов) — матчатся подстрокой за один проход по тексту
+_MATCH_KEYWORDS = build_keyword_matcher({
+    "help": ["что ты умеешь", "что можешь", "как дела"],
+    "delete": ["удали", "удалить", "стер", "сотри", "delete", "remove", "очисти", "wipe", "erase"],
+    "delete_obj": ["данные", "всё", "аккаунт", "account", "data", "history"],
+    "show": ["покажи", "показать", "show", "list", "выведи", "посмотреть", "какие расходы", "какие доходы"],
+    # что именно показать: фильтр по типу уходит в запрос к Firestore
+    "show_expense": ["расход", "трат", "expense", "spent", "spending"],
+    "show_income": ["доход", "income", "earning"],
+    "summary": ["сводка", "итого", "итоги", "summary", "total", "отчет", "отчёт"],
+    "advice": ["совет", "как экономить", "как сэкономить", "подскажи", "advice", "tips", "бюджет"],
+})
+
+# «оплатил долг» — и оплата, и долг: побеждает более конкретный тип
+_KIND_PRIORITY = ("pay_debt", "debt", "income", "expense")
+
 class FallbackRouter:
     def route(self, text: str) -> Route:
         t = clean_text(text)
         tl = t.lower()
+        hits = _MATCH_KEYWORDS(tl)
 
         # HELP / greetings
-        if any(x in tl for x in ["что ты умеешь", "помощь", "help", "команды", "что можешь", "как дела", "привет", "hello", "hi", "ку", "куку", "ау"]):
+        if "help" in hits or not _HELP_WORDS.isdisjoint(words(tl)):
             return Route(intent="HELP")
 
         # DELETE
-        if any(x in tl for x in ["удали", "удалить", "стер", "сотри", "delete", "remove", "очисти", "wipe", "erase"]) and any(x in tl for x in ["данные", "всё", "аккаунт", "account", "data", "history"]):
+        if "delete" in hits and "delete_obj" in hits:
             return Route(intent="DELETE_DATA")
 
         # SHOW / SUMMARY
-        if any(x in tl for x in ["покажи", "показать", "show", "list", "выведи", "посмотреть", "какие расходы", "какие доходы"]):
-            days = parse_days(t) or 7
-            return Route(intent="SHOW", days=days)
+        if "show" in hits:
+            days = parse_days(tl, lower=False) or 7
+            # «покажи расходы и доходы» — без фильтра
+            kind = None
+            if "show_expense" in hits and "show_income" not in hits:
+                kind = "expense"
+            elif "show_income" in hits and "show_expense" not in hits:
+                kind = "income"
+            return Route(intent="SHOW", kind=kind, days=days)
 
-        if any(x in tl for x in ["сводка", "итого", "итоги", "summary", "total", "отчет", "отчёт"]):
-            days = parse_days(t) or 7
+        if "summary" in hits:
+            days = parse_days(tl, lower=False) or 7
             return Route(intent="SUMMARY", days=days)
 
         # ADVICE
-        if any(x in tl for x in ["совет", "как экономить", "как сэкономить", "подскажи", "advice", "tips", "бюджет"]):
+        if "advice" in hits:
             return Route(intent="ADVICE")
 
         # LOG
         amt = parse_amount(t)
         if amt is not None:
-            # определяем тип
-            if is_pay_debt_phrase(t):
-                return Route(intent="LOG", kind="pay_debt", amount=amt, note=t)
-            if is_debt_phrase(t):
-                return Route(intent="LOG", kind="debt", amount=amt, note=t)
-            if is_income_phrase(t):
-                return Route(intent="LOG", kind="income", amount=amt, note=t)
-            if is_expense_phrase(t):
-                return Route(intent="LOG", kind="expense", amount=amt, note=t)
+            # определяем тип: при нескольких совпадениях приоритет как в _KIND_PRIORITY,
             # если просто "кофе 5" — это расход
-            return Route(intent="LOG", kind="expense", amount=amt, note=t)
+            kinds = classify_phrase(tl, lower=False)
+            kind = next((k for k in _KIND_PRIORITY if k in kinds), "expense")
+            return Route(intent="LOG", kind=kind, amount=amt, note=t)
 
         return Route(intent="UNKNOWN")
@@ -1,86 +1,236 @@
 from __future__ import annotations
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from dataclasses import dataclass
-from typing import Literal
+from typing import Callable, Literal
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, Timeout
+
+try:
+    import orjson  # в разы быстрее stdlib json; без него всё работает на json
+except ImportError:
+    orjson = None
 
 from prompts import SYSTEM_PROMPT_RU
 from utils import clean_text
 
+# сколько запросов к OpenAI одновременно: brain.handle крутится в потоках, держим ниже лимита RPM
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "20"))
+# у роутинга и совета есть локальный fallback — не держим хендлер на общем бюджете клиента
+# (4 попытки × 20 с): одна повторная попытка по 10 с, дальше отвечаем без LLM
+LLM_TIMEOUT = Timeout(10.0, connect=2.0)
+LLM_MAX_RETRIES = 1
+
 Intent = Literal["LOG", "SHOW", "SUMMARY", "ADVICE", "DELETE_DATA", "HELP", "UNKNOWN"]
 
-@dataclass
+# frozen: один и тот же объект отдаётся из кэша разным пользователям
+@dataclass(slots=True, frozen=True)
 class LLMResult:
-    intent: Intent
+    intent: Intent = "UNKNOWN"
     kind: str | None = None
     amount: float | None = None
     days: int | None = None
     note: str | None = None
     confidence: float | None = None
 
+    @classmethod
+    def from_raw(cls, data: dict) -> LLMResult:
+        # модель иногда пишет строку "null" вместо null — чистим за один проход
+        raw = {k: (None if v == "null" else v) for k, v in data.items()}
+        # проверяем форму ответа по той же схеме: чужие значения → UNKNOWN / None
+        intent = raw.get("intent")
+        kind = raw.get("kind")
+        note = raw.get("note")
+        return cls(
+            intent=intent if intent in _INTENTS else "UNKNOWN",
+            kind=kind if kind in _KINDS else None,
+            amount=_number(raw.get("amount")),
+            days=_number(raw.get("days")),
+            note=note if isinstance(note, str) else None,
+            confidence=_number(raw.get("confidence")),
+        )
+
+# Форму ответа задаёт _ROUTE_SCHEMA (structured outputs), поэтому в самом промпте её не расписываем.
+# Статичная часть собирается один раз; в запросе меняется только текст пользователя в конце.
+_ROUTE_PROMPT = """Определи намерение и заполни поля ответа.
+
+Текст пользователя: """
+
+# structured outputs: модель обязана вернуть объект ровно такой формы
+_ROUTE_SCHEMA = {
+    "name": "finance_router",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "intent": {"type": "string", "enum": ["LOG", "SHOW", "SUMMARY", "ADVICE", "DELETE_DATA", "HELP", "UNKNOWN"]},
+            "kind": {
+                "anyOf": [{"type": "string", "enum": ["expense", "income", "debt", "pay_debt"]}, {"type": "null"}],
+                "description": "тип записи для LOG (pay_debt — оплата долга); для SHOW — только если просят записи одного типа",
+            },
+            "amount": {"type": ["number", "null"], "description": "сумма для LOG"},
+            "days": {"type": ["number", "null"], "description": "период в днях для SHOW/SUMMARY (неделя = 7, месяц = 30)"},
+            "note": {"type": ["string", "null"], "description": "на что трата/откуда доход, коротко"},
+            "confidence": {"type": "number", "description": "уверенность 0..1"},
+        },
+        "required": ["intent", "kind", "amount", "days", "note", "confidence"],
+        "additionalProperties": False,
+    },
+}
+_ROUTE_FORMAT = {"type": "json_schema", "json_schema": _ROUTE_SCHEMA}
+_INTENTS = frozenset(_ROUTE_SCHEMA["schema"]["properties"]["intent"]["enum"])
+_KINDS = frozenset(_ROUTE_SCHEMA["schema"]["properties"]["kind"]["anyOf"][0]["enum"])
+
+def _number(v) -> float | None:
+    # brain делает float(amount)/int(days) — строка или bool оттуда уронили бы обработчик
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return v
+    return None
+
+_JSON_DECODER = json.JSONDecoder()
+_loads = orjson.loads if orjson else json.loads
+
+def _extract_json(content: str) -> dict | None:
+    # обычно ответ — ровно один JSON-объект
+    if content.startswith("{") and content.endswith("}"):
+        try:
+            return _loads(content)
+        except ValueError:
+            pass
+    # иногда модель может добавить мусор — берём первый объект от «{», хвост игнорируем
+    start = content.find("{")
+    if start == -1:
+        return None
+    data, _ = _JSON_DECODER.raw_decode(content, start)
+    return data if isinstance(data, dict) else None
+
+class LLMCache:
+    # LRU с TTL; потокобезопасный — route() вызывается из нескольких потоков (brain.handle в asyncio.to_thread)
+    def __init__(self, maxsize: int = 10_000, ttl: float = 1800.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[LLMResult, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, instructions: str, user_text: str) -> str:
+        payload = {"m": model, "i": instructions, "u": user_text}
+        if orjson:
+            raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+        else:
+            raw = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, key: str) -> LLMResult | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if time.monotonic() - item[1] > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: LLMResult) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
 class LLMRouter:
-    def __init__(self, openai_client, model: str = "gpt-4o-mini"):
-        self.client = openai_client
+    # роутинг детерминированный (temperature=0) — поэтому его результат можно кэшировать
+    temperature = 0.0
+
+    def __init__(
+        self,
+        openai_client,
+        model: str = "gpt-4o-mini",
+        cache: LLMCache | None = None,
+        on_health: Callable[[bool], None] | None = None,
+    ):
+        self.client = openai_client.with_options(timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
         self.model = model
+        # сообщаем наружу (main.set_openai_health), доступен ли OpenAI по итогам реальных запросов
+        self._on_health = on_health
+        # одинаковые фразы ("кофе 5", "сводка за неделю") не гоняем в OpenAI повторно
+        self._cache = cache or LLMCache()
+        # одна и та же фраза уже в полёте (два «кофе 5» почти одновременно) — ждём её, а не шлём второй запрос
+        self._inflight: dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(OPENAI_CONCURRENCY)
+
+    def chat(self, messages: list[dict], temperature: float, response_format: dict | None = None) -> str:
+        # все chat-запросы (роутинг, совет) идут через один лимит параллельности
+        kwargs = {"response_format": response_format} if response_format else {}
+        try:
+            with self._slots:
+                resp = self.client.chat.completions.create(
+                    model=self.model,
+                    temperature=temperature,
+                    messages=messages,
+                    **kwargs,
+                )
+        except (APIConnectionError, APITimeoutError, InternalServerError):
+            # сеть/таймаут/5xx — OpenAI недоступен; прочие ошибки (400, 429) о доступности не говорят
+            if self._on_health:
+                self._on_health(False)
+            raise
+        if self._on_health:
+            self._on_health(True)
+        return (resp.choices[0].message.content or "").strip()
 
     def route(self, text: str) -> LLMResult:
         t = clean_text(text)
+        # с ненулевой температурой ответы на одну фразу различаются — не кэшируем
+        if self.temperature != 0:
+            return self._route(t)
+
+        key = LLMCache.key(self.model, SYSTEM_PROMPT_RU + _ROUTE_PROMPT, t)
+        hit = self._cache.get(key)
+        if hit is not None:
+            return hit
 
-        # ВАЖНО: просим строго JSON, без болтовни
-        user_prompt = f"""
-Определи намерение и верни СТРОГО JSON без markdown.
-
-Формат:
-{{
-  "intent": "LOG|SHOW|SUMMARY|ADVICE|DELETE_DATA|HELP|UNKNOWN",
-  "kind": "expense|income|debt|pay_debt|null",
-  "amount": number|null,
-  "days": number|null,
-  "note": string|null,
-  "confidence": number
-}}
-
-Текст пользователя: {t}
-"""
-
-        resp = self.client.chat.completions.create(
-            model=self.model,
-            temperature=0.2,
-            messages=[
+        with self._inflight_lock:
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = self._inflight[key] = Future()
+        if not owner:
+            return fut.result()
+
+        try:
+            res = self._route(t)
+            # UNKNOWN не кэшируем — это может быть сбой парсинга, а не ответ модели
+            if res.intent != "UNKNOWN":
+                self._cache.set(key, res)
+            fut.set_result(res)
+            return res
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def _route(self, t: str) -> LLMResult:
+        user_prompt = f"{_ROUTE_PROMPT}{t}\n"
+
+        content = self.chat(
+            [
                 {"role": "system", "content": SYSTEM_PROMPT_RU},
                 {"role": "user", "content": user_prompt},
             ],
-            timeout=20,
-        )
-
-        content = (resp.choices[0].message.content or "").strip()
-        # иногда модель может добавить мусор — пробуем вытащить JSON
-        start = content.find("{")
-        end = content.rfind("}")
-        if start == -1 or end == -1 or end <= start:
-            return LLMResult(intent="UNKNOWN", note=t, confidence=0.0)
-
-        data = json.loads(content[start:end+1])
-        intent = data.get("intent") or "UNKNOWN"
-        kind = data.get("kind")
-        amount = data.get("amount")
-        days = data.get("days")
-        note = data.get("note")
-        conf = data.get("confidence")
-
-        if kind == "null":
-            kind = None
-        if note == "null":
-            note = None
-        if amount == "null":
-            amount = None
-        if days == "null":
-            days = None
-
-        return LLMResult(
-            intent=intent,
-            kind=kind,
-            amount=amount,
-            days=days,
-            note=note,
-            confidence=conf,
+            temperature=self.temperature,
+            response_format=_ROUTE_FORMAT,
         )
+        data = _extract_json(content)
+        if data is None:
+            return LLMResult(note=t, confidence=0.0)
+        return LLMResult.from_raw(data)
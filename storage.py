@@ -1,8 +1,17 @@
 from __future__ import annotations
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Any
 
+from cachetools import TTLCache
+from google.api_core.exceptions import FailedPrecondition
+
+logger = logging.getLogger(__name__)
+
 @dataclass
 class Tx:
     ts: datetime
@@ -11,20 +20,63 @@ class Tx:
     note: str
     currency: str
 
+# профиль читается на каждое сообщение — держим его в памяти процесса недолго
+PROFILE_TTL = 30.0
+# сводку («сводка», «совет») часто просят подряд; свои записи сбрасывают её сразу
+SUMMARY_TTL = 300.0
+
+_KINDS = ("income", "expense", "debt", "pay_debt")
+# агрегации сводки уходят в Firestore параллельно, по запросу на тип
+_AGG_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="fs-agg")
+
 class Storage:
     def __init__(self, db):
         self.db = db
+        # ограниченный по размеру: неактивные пользователи вытесняются, а не копятся в памяти;
+        # TTLCache не потокобезопасен, а handle крутится в потоках
+        self._profile_cache: TTLCache[int, dict[str, Any]] = TTLCache(maxsize=10_000, ttl=PROFILE_TTL)
+        self._profile_lock = threading.Lock()
+        # (uid, days) -> (поколение, сводка); сводка годна, пока поколение пользователя не сменилось
+        self._summary_cache: TTLCache[tuple[int, int], tuple[int, dict[str, Any]]] = TTLCache(
+            maxsize=10_000, ttl=SUMMARY_TTL
+        )
+        # uid -> поколение: add_tx/удаление ставят новое. Номера из общего счётчика не повторяются,
+        # а запись живёт не меньше любой сводки, посчитанной до неё
+        self._summary_gen: TTLCache[int, int] = TTLCache(maxsize=100_000, ttl=SUMMARY_TTL)
+        self._gen_seq = itertools.count(1)
+        self._summary_lock = threading.Lock()
 
     def user_doc(self, uid: int):
         return self.db.collection("users").document(str(uid))
 
+    def _cached_profile(self, uid: int) -> dict[str, Any] | None:
+        with self._profile_lock:
+            return self._profile_cache.get(uid)
+
+    def _bump_summary_gen(self, uid: int) -> None:
+        with self._summary_lock:
+            self._summary_gen[uid] = next(self._gen_seq)
+
+    def _drop_profile(self, uid: int) -> None:
+        with self._profile_lock:
+            self._profile_cache.pop(uid, None)
+
     def get_profile(self, uid: int) -> dict[str, Any]:
+        cached = self._cached_profile(uid)
+        if cached is not None:
+            return dict(cached)
         doc = self.user_doc(uid).get()
-        if doc.exists:
-            return doc.to_dict() or {}
-        return {}
+        data = (doc.to_dict() or {}) if doc.exists else {}
+        with self._profile_lock:
+            self._profile_cache[uid] = data
+        return dict(data)
 
     def set_profile(self, uid: int, data: dict[str, Any]) -> None:
+        # «валюта EUR» при уже стоящей EUR — запись в Firestore не нужна
+        cached = self._cached_profile(uid)
+        if cached is not None and all(cached.get(k) == v for k, v in data.items()):
+            return
+        self._drop_profile(uid)
         self.user_doc(uid).set(data, merge=True)
 
     def add_tx(self, uid: int, tx: Tx) -> str:
@@ -36,13 +88,31 @@ class Storage:
             "note": tx.note,
             "currency": tx.currency,
         })
+        self._bump_summary_gen(uid)
         return ref.id
 
-    def list_tx(self, uid: int, days: int = 7, kind: str | None = None) -> list[dict[str, Any]]:
+    def _tx_since(self, uid: int, days: int, kind: str | None = None):
         since = datetime.now(timezone.utc) - timedelta(days=days)
-        q = self.user_doc(uid).collection("tx").where("ts", ">=", since).order_by("ts", direction="DESCENDING")
+        q = self.user_doc(uid).collection("tx").where("ts", ">=", since)
         if kind:
             q = q.where("kind", "==", kind)
+        return q
+
+    def list_tx(self, uid: int, days: int = 7, kind: str | None = None, limit: int | None = None) -> list[dict[str, Any]]:
+        try:
+            return self._list_tx(uid, days, kind, limit)
+        except FailedPrecondition:
+            if not kind:
+                raise
+            # фильтр по типу требует индекс tx(kind, ts DESC); пока его нет — фильтруем сами
+            logger.warning("tx(kind, ts desc) index is missing, filtering rows client-side")
+            rows = [r for r in self._list_tx(uid, days, None, None) if r.get("kind") == kind]
+            return rows[:limit] if limit else rows
+
+    def _list_tx(self, uid: int, days: int, kind: str | None, limit: int | None) -> list[dict[str, Any]]:
+        q = self._tx_since(uid, days, kind).order_by("ts", direction="DESCENDING")
+        if limit:
+            q = q.limit(limit)
         docs = q.stream()
         out = []
         for d in docs:
@@ -51,7 +121,70 @@ class Storage:
             out.append(row)
         return out
 
+    def count_tx(self, uid: int, days: int = 7, kind: str | None = None) -> int:
+        # count() считает Firestore: сами документы не передаются
+        try:
+            res = self._tx_since(uid, days, kind).count(alias="n").get()
+        except FailedPrecondition:
+            if not kind:
+                raise
+            # индекса tx(kind, ts) ещё нет — считаем сами, забирая только поле kind
+            logger.warning("tx(kind, ts) index is missing, counting rows client-side")
+            docs = self._tx_since(uid, days).select(["kind"]).stream()
+            return sum(1 for d in docs if (d.to_dict() or {}).get("kind") == kind)
+        return int(res[0][0].value)
+
     def summary(self, uid: int, days: int = 7) -> dict[str, Any]:
+        with self._summary_lock:
+            gen = self._summary_gen.get(uid, 0)
+            cached = self._summary_cache.get((uid, days))
+        if cached and cached[0] == gen:
+            return dict(cached[1])
+        out = self._summary(uid, days)
+        with self._summary_lock:
+            # пока считали, add_tx мог добавить запись — такую сводку не кэшируем
+            if self._summary_gen.get(uid, 0) == gen:
+                self._summary_cache[(uid, days)] = (gen, out)
+        return dict(out)
+
+    def _summary(self, uid: int, days: int) -> dict[str, Any]:
+        try:
+            return self._summary_agg(uid, days)
+        except FailedPrecondition:
+            # составного индекса ещё нет (firestore.indexes.json не задеплоен или строится) — считаем по строкам
+            logger.warning("tx(kind, ts) index is missing, summing summary rows client-side")
+            return self._summary_rows(uid, days)
+
+    def _summary_agg(self, uid: int, days: int) -> dict[str, Any]:
+        # суммы и количество считает сам Firestore (aggregation queries): документы по сети не тянем.
+        # нужен составной индекс tx(kind, ts) — см. firestore.indexes.json,
+        # деплой: firebase deploy --only firestore:indexes (подхватывается через firebase.json)
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        col = self.user_doc(uid).collection("tx")
+
+        def agg(kind: str) -> tuple[float, int]:
+            q = col.where("kind", "==", kind).where("ts", ">=", since)
+            res = {r.alias: r.value for r in q.count(alias="n").sum("amount", alias="s").get()[0]}
+            return float(res.get("s") or 0), int(res.get("n") or 0)
+
+        def last_currency() -> str | None:
+            q = col.where("ts", ">=", since).order_by("ts", direction="DESCENDING").limit(1).select(["currency"])
+            for d in q.stream():
+                return (d.to_dict() or {}).get("currency")
+            return None
+
+        cur_f = _AGG_POOL.submit(last_currency)
+        totals = dict(zip(_KINDS, _AGG_POOL.map(agg, _KINDS)))
+        return {
+            "income": totals["income"][0],
+            "expense": totals["expense"][0],
+            "debt_added": totals["debt"][0],
+            "debt_paid": totals["pay_debt"][0],
+            "currency": cur_f.result() or "USD",
+            "count": sum(n for _, n in totals.values()),
+        }
+
+    def _summary_rows(self, uid: int, days: int) -> dict[str, Any]:
         rows = self.list_tx(uid, days=days)
         income = 0.0
         expense = 0.0
@@ -80,10 +213,7 @@ class Storage:
         }
 
     def delete_all_user_data(self, uid: int) -> None:
-        # удаляем tx
-        tx_ref = self.user_doc(uid).collection("tx")
-        docs = list(tx_ref.stream())
-        for d in docs:
-            d.reference.delete()
-        # удаляем профиль
-        self.user_doc(uid).delete()
+        # recursive_delete сам обходит подколлекции (tx) и удаляет их через BulkWriter, затем сам профиль
+        self.db.recursive_delete(self.user_doc(uid))
+        self._drop_profile(uid)
+        self._bump_summary_gen(uid)
@@ -1,26 +1,36 @@
 import re
 from datetime import datetime, timezone
+from typing import Callable, Iterable
+
+# компилируем один раз: parse_days / parse_amount вызываются на каждое сообщение
+_DAYS_RE = re.compile(r"(\d{1,3})\s*(дн|дня|дней|day|days)")
+_AMOUNT_RE = re.compile(r"(?<!\d)(\d{1,9}(?:\.\d{1,2})?)(?!\d)")
+_WS_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"\w+")
+_CYR_RE = re.compile(r"[А-Яа-яЁё]")
+# слово периода → дней; проверяются по порядку, подстрокой
+_PERIOD_WORDS = (("недел", 7), ("week", 7), ("месяц", 30), ("month", 30))
 
 def now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
 def clean_text(s: str) -> str:
     s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     return s
 
 def detect_lang_ru(text: str) -> bool:
     # если есть кириллица — почти точно русский
-    return bool(re.search(r"[А-Яа-яЁё]", text or ""))
+    return bool(_CYR_RE.search(text or ""))
 
-def parse_days(text: str) -> int | None:
-    t = (text or "").lower()
+def parse_days(text: str, lower: bool = True) -> int | None:
+    # lower=False — текст уже в нижнем регистре, не копируем его ещё раз
+    t = (text or "").lower() if lower else (text or "")
     # 7 дней / неделя
-    if "недел" in t or "week" in t:
-        return 7
-    if "месяц" in t or "month" in t:
-        return 30
-    m = re.search(r"(\d{1,3})\s*(дн|дня|дней|day|days)", t)
+    for w, d in _PERIOD_WORDS:
+        if w in t:
+            return d
+    m = _DAYS_RE.search(t)
     if m:
         try:
             return max(1, min(365, int(m.group(1))))
@@ -31,7 +41,7 @@ def parse_days(text: str) -> int | None:
 def parse_amount(text: str) -> float | None:
     # ищем число: 8 / 8.5 / 8,5 / $8
     t = (text or "").replace(",", ".")
-    m = re.search(r"(?<!\d)(\d{1,9}(?:\.\d{1,2})?)(?!\d)", t)
+    m = _AMOUNT_RE.search(t)
     if not m:
         return None
     try:
@@ -39,30 +49,53 @@ def parse_amount(text: str) -> float | None:
     except:
         return None
 
-def is_income_phrase(t: str) -> bool:
-    t = t.lower()
-    keys = ["доход", "income", "получил", "заработал", "paid", "got paid"]
-    return any(k in t for k in keys)
+def words(tl: str) -> frozenset[str]:
+    # набор слов сообщения: короткие ключевые слова («hi», «ку») сверяем целиком,
+    # иначе они находятся внутри других слов («this», «купил»)
+    return frozenset(_WORD_RE.findall(tl))
+
+def build_keyword_matcher(tables: dict[str, Iterable[str]]) -> Callable[[str], set[str]]:
+    # Все таблицы ключевых слов → один скомпилированный паттерн: один проход по тексту вместо
+    # десятков any(k in t for k in ...). Семантика та же — поиск подстроки.
+    own: dict[str, set[str]] = {}
+    for tag, kws in tables.items():
+        for w in kws:
+            own.setdefault(w.lower(), set()).add(tag)
+    # в каждой позиции паттерн находит только самое длинное слово; более короткие,
+    # начинающиеся там же, — его префиксы, поэтому их теги добавляем заранее
+    tags = {w: frozenset().union(*(own[p] for p in own if w.startswith(p))) for w in own}
+    alt = "|".join(re.escape(w) for w in sorted(own, key=len, reverse=True))
+    pattern = re.compile(f"(?=({alt}))")
+
+    def match(tl: str) -> set[str]:
+        hits: set[str] = set()
+        for m in pattern.finditer(tl):
+            hits |= tags[m.group(1)]
+        return hits
 
-def is_expense_phrase(t: str) -> bool:
-    t = t.lower()
-    keys = ["расход", "потрат", "spent", "expense", "купил", "buy", "coffee", "кофе", "бензин", "gas", "diesel"]
-    return any(k in t for k in keys)
+    return match
 
-def is_debt_phrase(t: str) -> bool:
-    t = t.lower()
-    keys = ["долг", "debt", "на долг", "в долг", "loan"]
-    return any(k in t for k in keys)
+# ключевые слова типов записи; classify_phrase находит все за один проход
+_KIND_KEYWORDS = {
+    "income": ["доход", "income", "получил", "заработал", "paid", "got paid"],
+    "expense": ["расход", "потрат", "spent", "expense", "купил", "buy", "coffee", "кофе", "бензин", "gas", "diesel"],
+    "debt": ["долг", "debt", "на долг", "в долг", "loan"],
+    "pay_debt": ["оплат", "погас", "вернул", "paid debt", "pay debt", "закрыл долг"],
+}
+_MATCH_KINDS = build_keyword_matcher(_KIND_KEYWORDS)
 
-def is_pay_debt_phrase(t: str) -> bool:
-    t = t.lower()
-    keys = ["оплат", "погас", "вернул", "paid debt", "pay debt", "закрыл долг"]
-    return any(k in t for k in keys)
+def classify_phrase(t: str, lower: bool = True) -> set[str]:
+    # все типы, чьи ключевые слова встречаются в тексте (подстрокой)
+    return _MATCH_KINDS(t.lower() if lower else t)
 
 def fmt_money(amount: float, currency: str) -> str:
     cur = (currency or "USD").upper().strip()
     symbol = "$" if cur == "USD" else (cur + " ")
+    # считаем в целых центах: 4.999999 → 5, без сравнения float с допуском
+    cents = round(amount * 100)
+    sign = "-" if cents < 0 else ""
+    units, frac = divmod(abs(cents), 100)
     # 2 знака только если нужно
-    if abs(amount - int(amount)) < 1e-9:
-        return f"{symbol}{int(amount)}"
-    return f"{symbol}{amount:.2f}"
+    if frac == 0:
+        return f"{symbol}{sign}{units}"
+    return f"{symbol}{sign}{units}.{frac:02d}"